@@ -1,7 +1,26 @@
+import hashlib
+import pathlib
+from collections import OrderedDict
+
 import streamlit as st
-import pandas as pd
-import google.generativeai as genai
-from tenacity import retry, stop_after_attempt, wait_exponential
+
+from foster_core import (
+    MAX_CACHED_DRAFTS,
+    MIN_INPUT_CHARS,
+    PROMPT_PREFIX,
+    PROMPT_SUFFIX,
+    REQUIRED_COLUMNS,
+    build_context,
+    csv_columns,
+    file_digest,
+    get_available_models,
+    load_database,
+    open_generation,
+    pick_model,
+    query_terms,
+    start_index_build,
+    stream_text,
+)
 
 # --- 1. PAGE CONFIGURATION ---
 st.set_page_config(
@@ -11,90 +30,68 @@ st.set_page_config(
 )
 
 # --- 2. CUSTOM CSS (High Contrast & Readability) ---
-st.markdown("""
-    <style>
-        /* Main Sidebar Background */
-        [data-testid="stSidebar"] { 
-            background-color: #0e2f44; 
-        }
-        
-        /* FORCE all sidebar text to be white and readable */
-        [data-testid="stSidebar"] p, 
-        [data-testid="stSidebar"] span, 
-        [data-testid="stSidebar"] label, 
-        [data-testid="stSidebar"] div { 
-            color: #ffffff !important; 
-        }
-        
-        /* Input fields in sidebar (Text Input & Select Box) */
-        [data-testid="stSidebar"] input {
-            color: #0e2f44 !important; /* Text inside box is dark */
-            background-color: #ffffff !important; /* Box background is white */
-        }
-        
-        /* Headers */
-        h1 { color: #0e2f44; font-family: 'Helvetica Neue', sans-serif; font-weight: 700; }
-        
-        /* Text Area Styling */
-        .stTextArea textarea { background-color: #f8f9fa; border: 1px solid #dcdcdc; }
-        
-        /* Success Message Styling */
-        .stSuccess { background-color: #d4edda; color: #155724; border-color: #c3e6cb; }
-        
-        /* Button Width */
-        div[data-testid="stVerticalBlock"] > button { width: 100%; }
-    </style>
-""", unsafe_allow_html=True)
-
-# --- 3. HELPER FUNCTIONS ---
-
-def get_available_models(api_key):
+@st.cache_resource
+def load_css():
     """
-    Fetches the real list of models from Google.
+    Reads the bundled stylesheet once per process and wraps it for injection.
     """
-    genai.configure(api_key=api_key)
-    try:
-        models = genai.list_models()
-        return [m.name for m in models if 'generateContent' in m.supported_generation_methods]
-    except Exception as e:
-        return []
+    css = (pathlib.Path(__file__).parent / "assets" / "style.css").read_text(encoding="utf-8")
+    return f"<style>\n{css}</style>"
 
-@st.cache_data
-def load_database(file):
-    return pd.read_csv(file)
+st.markdown(load_css(), unsafe_allow_html=True)
 
-# --- 4. SIDEBAR ---
+# --- 3. SIDEBAR ---
 with st.sidebar:
-    st.image("https://placehold.co/200x80/0e2f44/ffffff/png?text=Foster+Finance", use_column_width=True)
+    st.image("https://placehold.co/200x80/0e2f44/ffffff/png?text=Foster+Finance", width="stretch")
     st.markdown("---")
     st.header("⚙️ Configuration")
     
-    # 1. API Key Input
-    api_key = st.text_input("Google API Key", type="password", key="api_key_input")
-    
+    # 1. API Key Input (batched in a form: the script only reruns on "Connect")
+    with st.form("config"):
+        api_key_text = st.text_input(
+            "Google API Key(s)",
+            type="password",
+            key="api_key_input",
+            help="Separate several keys with commas to spread requests across their rate limits."
+        )
+        st.form_submit_button("🔌 Connect", width="stretch")
+
+    api_keys = [k.strip() for k in api_key_text.split(',') if k.strip()]
+    api_key = api_keys[0] if api_keys else ""
+
+# --- 4. MAIN LOGIC ---
+
+st.title("🏦 Foster Finance Deal Assistant")
+st.markdown("##### AI-Powered Credit Proposal Generator")
+
+uploaded_file = st.file_uploader("📂 Upload Foundation Database (CSV)", type=['csv'])
+
+if uploaded_file is not None:
+    # Read and digest the upload once per rerun; the file-keyed caches hash only the digest.
+    file_bytes = uploaded_file.getvalue()
+    file_key = file_digest(file_bytes)
+    index_future = start_index_build(file_key, file_bytes)
+
+# Sidebar model picker is filled in after the index build starts, so the model-list
+# fetch overlaps it.
+with st.sidebar:
     selected_model = None
     
     # 2. Smart Model Selection
     if api_key:
-        available_models = get_available_models(api_key)
+        # Every key is checked against the model list; rejected ones (typos, revoked
+        # keys) are left out of the rotation.
+        key_models = {k: get_available_models(k) for k in api_keys}
+        api_keys = [k for k in key_models if key_models[k]]
+        available_models = key_models[api_keys[0]] if api_keys else []
         
         if available_models:
             st.success(f"✅ Connected! Found {len(available_models)} models.")
+            if len(api_keys) < len(key_models):
+                st.warning(f"⚠️ {len(key_models) - len(api_keys)} of {len(key_models)} keys were rejected and will not be used.")
             
             # --- AUTO-SELECT LOGIC (Gemini 3 First) ---
-            default_ix = 0
-            
-            # Priority 1: Gemini 3.0 Flash (The 2026 Standard)
-            for i, m in enumerate(available_models):
-                if 'gemini-3.0-flash' in m or 'gemini-3-flash' in m:
-                    default_ix = i
-                    break
-            else:
-                # Priority 2: Gemini 1.5 Flash (The Stable Fallback)
-                for i, m in enumerate(available_models):
-                    if 'gemini-1.5-flash' in m:
-                        default_ix = i
-                        break
+            default_ix = pick_model(available_models)
             
             # 3. Manual Override Dropdown
             selected_model = st.selectbox(
@@ -106,23 +103,16 @@ with st.sidebar:
         else:
             st.error("❌ Connection Failed. Check Key.")
 
-# --- 5. MAIN LOGIC ---
-
-st.title("🏦 Foster Finance Deal Assistant")
-st.markdown("##### AI-Powered Credit Proposal Generator")
-
-uploaded_file = st.file_uploader("📂 Upload Foundation Database (CSV)", type=['csv'])
-
 if uploaded_file is not None:
     try:
-        df = load_database(uploaded_file)
+        columns = csv_columns(file_key, file_bytes)
         
-        required_columns = ['Client Requirements', 'Client Objectives', 'Product Features', 'Why this Product was Selected']
-        missing = [col for col in required_columns if col not in df.columns]
+        missing = [col for col in REQUIRED_COLUMNS if col not in columns]
         
         if missing:
             st.error(f"❌ Error: CSV missing headers: {', '.join(missing)}")
         else:
+            df = load_database(file_key, file_bytes)
             st.success(f"✅ Database Active: {len(df)} deal scenarios loaded.")
             st.markdown("---")
             
@@ -134,64 +124,57 @@ if uploaded_file is not None:
             )
             
             st.markdown("<br>", unsafe_allow_html=True)
-            generate_btn = st.button("✨ Generate Proposal", type="primary", use_container_width=True)
+            generate_btn = st.button("✨ Generate Proposal", type="primary", width="stretch")
 
             # --- AI GENERATION ---
             if generate_btn and api_key and user_input:
                 if not selected_model:
                     st.error("⚠️ Please select a valid model from the sidebar first.")
+                elif len(user_input.strip()) < MIN_INPUT_CHARS:
+                    st.warning("⚠️ Please add more detail to the deal scenario.")
                 else:
                     
                     # A. SMART MATCHING
-                    user_terms = set(user_input.lower().replace(',', '').split())
-                    def calculate_score(row):
-                        row_text = str(row.values).lower()
-                        return sum(1 for term in user_terms if term in row_text)
+                    user_terms = query_terms(user_input)
+                    index_future.result()  # usually finished while the scenario was typed
+                    context_type, context_data = build_context(file_key, file_bytes, user_terms)
 
-                    df['match_score'] = df.apply(calculate_score, axis=1)
-                    matches = df.sort_values(by='match_score', ascending=False).head(3)
-                    
-                    context_type = "Historic Matches" if matches['match_score'].max() > 0 else "General Logic"
-                    context_data = matches[required_columns].to_markdown(index=False)
+                    # No reference rows add nothing to the prompt: ask before paying for the call.
+                    if context_type == "General Logic" and st.session_state.get('confirm_no_match') != (file_key, user_terms):
+                        st.session_state['confirm_no_match'] = (file_key, user_terms)
+                        st.warning("⚠️ No historic matches found for this scenario. Click **Generate Proposal** again to proceed without reference deals.")
+                        st.stop()
 
                     # B. PROMPT ENGINEERING
                     try:
-                        genai.configure(api_key=api_key)
-                        model = genai.GenerativeModel(selected_model)
+                        prompt = PROMPT_PREFIX + PROMPT_SUFFIX.format_map(
+                            {'user_input': user_input, 'context_type': context_type, 'context_data': context_data}
+                        )
                         
-                        prompt = f"""
-                        Role: Senior Credit Analyst at Foster Finance.
-                        Task: Write a deal summary ADAPTING the style of the Reference Database to the User's new scenario.
-
-                        USER INPUT (New Deal Details): 
-                        "{user_input}"
-
-                        REFERENCE DATABASE ({context_type}):
-                        {context_data}
-
-                        INSTRUCTIONS:
-                        1. **Structure:** Output a numbered list (1, 2, 3) followed by a separate paragraph for the 4th point.
-                        2. **Tone:** Mimic the sentence structure of the Reference Database exactly.
-                        3. **Constraint:** Do NOT use bold headers (e.g., NO "**Requirement:**"). Just start the sentence.
-
-                        SPECIFIC MAPPING INSTRUCTIONS:
-                        * **Bullet 1 (Requirements):** Mimic the Reference Database sentence structure, BUT add 10-15% more detail by explicitly stating the likely credit priority (e.g., "prioritising competitive rates" or "maximum borrowing") if not already stated.
-                        * **Bullet 2 (Objectives):** Strictly mimic the 'Client Objectives' column style.
-                        * **Bullet 3 (Features):** Strictly mimic the 'Product Features' column style.
-                        * **Point 4 (Selection):** Strictly mimic the 'Why this Product was Selected' column logic.
-
-                        Generate strict Markdown output.
-                        """
+                        # Identical model + prompt: re-show the earlier draft instead of paying for a new call.
+                        responses = st.session_state.setdefault('responses', OrderedDict())
+                        cache_key = hashlib.blake2b(f"{selected_model}\n{prompt}".encode(), digest_size=16).hexdigest()
+                        cached = responses.get(cache_key)
+                        if cached is not None:
+                            responses.move_to_end(cache_key)
                         
-                        with st.spinner(f"🤖 Analyzing with {selected_model}..."):
-                            @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
-                            def run_ai():
-                                return model.generate_content(prompt).text
-                            
-                            response = run_ai()
-                            st.markdown("### 📄 Draft Proposal")
-                            st.markdown("---")
-                            st.markdown(response)
+                        if cached is None:
+                            with st.spinner(f"🤖 Analyzing with {selected_model}..."):
+                                response = open_generation(api_keys, selected_model, prompt)
+
+                        st.markdown("### 📄 Draft Proposal")
+                        st.markdown("---")
+                        if cached is None:
+                            outcome = {}
+                            draft = st.write_stream(stream_text(response, outcome))
+                            # Only complete drafts are replayed; a cut-off one is retried on the next click.
+                            if outcome['finish_reason'] == 'STOP':
+                                responses[cache_key] = draft
+                                if len(responses) > MAX_CACHED_DRAFTS:
+                                    responses.popitem(last=False)
+                        else:
+                            st.caption("Showing the earlier draft for this exact scenario and model.")
+                            st.markdown(cached)
 
                     except Exception as e:
                         # --- CUSTOM ERROR HANDLING ---
@@ -201,7 +184,7 @@ if uploaded_file is not None:
                         if "404" in err_msg or "NotFound" in err_msg:
                             st.warning(f"ℹ️ **Action Required:** The model '{selected_model}' is not currently available for this key. \n\n👉 **Please go to the Sidebar > 'Active Model' and select 'Gemini 1.5 Flash' to continue.**")
                         elif "429" in err_msg or "ResourceExhausted" in err_msg:
-                            st.warning("ℹ️ **Action Required:** Daily Limit Reached. Please create a NEW Project Key or select a different model in the sidebar.")
+                            st.warning("ℹ️ **Action Required:** Daily Limit Reached. Please add or create a NEW Project Key or select a different model in the sidebar.")
                         else:
                             st.error(f"Technical Error: {e}")
 
@@ -0,0 +1,492 @@
+"""
+Matching, caching and Gemini helpers behind the Streamlit UI in app.py.
+Imported once per process, so reruns of app.py do not redefine them.
+"""
+import functools
+import hashlib
+import io
+import os
+import pathlib
+import pickle
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import streamlit as st
+import pandas as pd
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+@functools.lru_cache(maxsize=None)
+def _genai():
+    """
+    Imports the Gemini SDK on first use so it stays off the cold-start path.
+    """
+    import google.generativeai as genai
+    return genai
+
+@functools.lru_cache(maxsize=None)
+def _glm():
+    """
+    The low-level Gemini API clients, imported on first use like _genai().
+    """
+    from google.ai import generativelanguage as glm
+    return glm
+
+REQUIRED_COLUMNS = ['Client Requirements', 'Client Objectives', 'Product Features', 'Why this Product was Selected']
+TOKEN_RE = re.compile(r"\w+")
+# Filler words that would otherwise match almost every row.
+STOPWORDS = frozenset({
+    'the', 'a', 'an', 'and', 'or', 'of', 'to', 'for', 'with', 'in', 'on', 'at', 'is', 'are', 'have', 'has',
+})
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def list_generation_models(api_key):
+    """
+    Fetches the real list of models from Google, cached per key for a day in memory
+    only, and dropped early once generation rejects the key (see open_generation).
+    Errors propagate so that a failed lookup is never cached.
+    """
+    models = _glm().ModelServiceClient(client_options={"api_key": api_key}).list_models()
+    return [m.name for m in models if 'generateContent' in m.supported_generation_methods]
+
+@st.cache_resource(show_spinner=False)
+def get_client(api_key):
+    """
+    Live generation client for one API key, built once per key and reused across
+    sessions. The key is passed to the client itself rather than through the SDK's
+    process-global genai.configure(), which concurrent sessions would race on.
+    """
+    return _glm().GenerativeServiceClient(client_options={"api_key": api_key})
+
+# Bounds on every generation call, so a runaway or hung response cannot stall the session.
+# The timeout is the deadline for the whole stream, not just the first chunk, so it
+# leaves room for a slow model to write a full max_output_tokens draft.
+GENERATION_CONFIG = {"max_output_tokens": 2048, "temperature": 0.4, "candidate_count": 1}
+REQUEST_OPTIONS = {"timeout": 120}
+
+# Shorter inputs carry too little detail to be worth a generation call.
+MIN_INPUT_CHARS = 10
+
+# Drafts kept per session for replay; the least recently shown is evicted first.
+MAX_CACHED_DRAFTS = 10
+
+# Longest server-requested wait worth sitting through; beyond it, fail fast instead.
+MAX_RETRY_WAIT = 30
+
+def retry_after(exc):
+    """
+    Server-provided retry delay in seconds for a rate-limit error, or None. Read from
+    a `retry_after` attribute or from a google.rpc.RetryInfo entry in the error details
+    (a proto over gRPC, a dict with "retryDelay": "15s" over REST).
+    """
+    delay = getattr(exc, 'retry_after', None)
+    if delay is not None:
+        return float(delay)
+    for detail in getattr(exc, 'details', None) or ():
+        if isinstance(detail, dict):
+            if 'retryDelay' in detail:
+                return float(str(detail['retryDelay']).rstrip('s'))
+        elif hasattr(detail, 'retry_delay'):
+            return detail.retry_delay.seconds + detail.retry_delay.nanos / 1e9
+    return None
+
+@functools.lru_cache(maxsize=None)
+def start_generation(retry_rate_limits=True):
+    """
+    Retrying callable that opens a streamed generation, built once per process.
+    Only the request itself is retried; a consumed stream cannot be replayed.
+    Only transient errors are retried, honouring any server-provided delay; model
+    and permission errors surface immediately. With retry_rate_limits=False a 429
+    is raised at once, so the caller can switch keys instead of waiting.
+    """
+    from google.api_core import exceptions
+    from tenacity import retry, retry_if_exception_type, stop_after_attempt, stop_any, wait_exponential
+
+    backoff = wait_exponential(multiplier=1, min=2, max=10)
+
+    def wait(retry_state):
+        delay = retry_after(retry_state.outcome.exception())
+        return delay if delay is not None else backoff(retry_state)
+
+    def wait_too_long(retry_state):
+        delay = retry_after(retry_state.outcome.exception())
+        return delay is not None and delay > MAX_RETRY_WAIT
+
+    transient = (exceptions.ServiceUnavailable, exceptions.DeadlineExceeded)
+    if retry_rate_limits:
+        transient += (exceptions.ResourceExhausted,)
+
+    @retry(
+        retry=retry_if_exception_type(transient),
+        stop=stop_any(stop_after_attempt(3), wait_too_long),
+        wait=wait,
+        reraise=True,
+    )
+    def generate(client, model_name, prompt):
+        glm = _glm()
+        request = glm.GenerateContentRequest(
+            model=model_name,
+            contents=[glm.Content(role='user', parts=[glm.Part(text=prompt)])],
+            generation_config=GENERATION_CONFIG,
+        )
+        stream = client.stream_generate_content(request, **REQUEST_OPTIONS)
+        # Pulls the first chunk, so connection and quota errors are raised (and retried) here.
+        return _genai().types.GenerateContentResponse.from_iterator(stream)
+
+    return generate
+
+# How long a failing key sits out when the server gives no retry delay.
+KEY_COOLDOWN = 60
+
+def open_generation(api_keys, model_name, prompt):
+    """
+    Opens a streamed generation, rotating round-robin across api_keys. A key whose
+    request fails (rate limit, rejected or revoked key, outage, ...) cools down, for
+    the server's retry delay if given, and the next key is tried at once; the last
+    candidate uses the full retry policy and its error is raised.
+    """
+    from google.api_core import exceptions
+
+    cooldown = st.session_state.setdefault('key_cooldown', {})
+    now = time.time()
+    ready = [k for k in api_keys if cooldown.get(k, 0) <= now] or list(api_keys)
+    start = st.session_state.get('key_idx', 0) % len(ready)
+    st.session_state['key_idx'] = start + 1
+    order = ready[start:] + ready[:start]
+
+    def attempt(key, retry_rate_limits=True):
+        try:
+            return start_generation(retry_rate_limits)(get_client(key), model_name, prompt)
+        except (exceptions.PermissionDenied, exceptions.Unauthenticated, exceptions.InvalidArgument):
+            # Possibly a revoked or invalid key: re-list its models on the next rerun,
+            # so the sidebar stops reporting it as connected.
+            list_generation_models.clear(api_key=key)
+            raise
+
+    for key in order[:-1]:
+        try:
+            return attempt(key, retry_rate_limits=False)
+        except exceptions.GoogleAPICallError as e:
+            cooldown[key] = time.time() + (retry_after(e) or KEY_COOLDOWN)
+    return attempt(order[-1])
+
+def stream_text(response, outcome=None):
+    """
+    Yields the text of each streamed chunk, skipping chunks without content parts
+    (e.g. a trailing usage-metadata chunk). A blocked prompt yields a note with the
+    block reason instead of a draft. If the model stops short of a normal finish
+    (length cap, safety filter, request deadline, ...), the partial draft is kept
+    and a note saying so is appended.
+    If an outcome dict is given, outcome['finish_reason'] is set to why the stream
+    ended ('STOP' for a complete draft), so the caller can tell whether to keep it.
+    """
+    from google.api_core import exceptions
+
+    if outcome is None:
+        outcome = {}
+    finish_reason = None
+    try:
+        for chunk in response:
+            if chunk.candidates:
+                finish_reason = chunk.candidates[0].finish_reason.name
+                if chunk.candidates[0].content.parts:
+                    yield chunk.text
+    except _genai().types.BlockedPromptException:
+        outcome['finish_reason'] = 'BLOCKED'
+        yield f"> ⚠️ The request was blocked ({response.prompt_feedback.block_reason.name}); no draft was generated."
+        return
+    except exceptions.DeadlineExceeded:
+        finish_reason = 'DEADLINE_EXCEEDED'
+    outcome['finish_reason'] = finish_reason
+    if finish_reason is not None and finish_reason not in ('STOP', 'FINISH_REASON_UNSPECIFIED'):
+        yield f"\n\n> ⚠️ Generation stopped early ({finish_reason}); this draft is incomplete."
+
+def get_available_models(api_key):
+    try:
+        return list_generation_models(api_key)
+    except Exception as e:
+        return []
+
+def file_digest(file_bytes):
+    """
+    Short digest of the uploaded CSV. The file-keyed caches below hash this instead
+    of the raw bytes, which they take as an unhashed `_file_bytes` argument.
+    """
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+@st.cache_data(show_spinner=False)
+def csv_columns(key, _file_bytes):
+    """
+    Header row of the CSV, read without parsing any data rows.
+    """
+    return pd.read_csv(io.BytesIO(_file_bytes), nrows=0).columns.tolist()
+
+@st.cache_data(show_spinner=False)
+def load_database(key, _file_bytes):
+    """
+    Parses only the REQUIRED_COLUMNS of the CSV; check csv_columns() first.
+    """
+    try:
+        df = pd.read_csv(io.BytesIO(_file_bytes), usecols=REQUIRED_COLUMNS, engine='pyarrow', dtype_backend='pyarrow')
+    except ImportError:
+        # pyarrow not installed: fall back to the default C parser.
+        df = pd.read_csv(io.BytesIO(_file_bytes), usecols=REQUIRED_COLUMNS)
+    # Repetitive text columns (e.g. product names) are stored once per distinct value.
+    for col in df.columns:
+        if pd.api.types.is_string_dtype(df[col]) and df[col].nunique() < 0.5 * len(df):
+            df[col] = df[col].astype('category')
+    return df
+
+@st.cache_data
+def build_corpus(key, _file_bytes):
+    """
+    Lowercased text of the required columns, one string per row, for matching.
+    """
+    text = load_database(key, _file_bytes)[REQUIRED_COLUMNS].astype('string').fillna('')
+    first, *rest = (text[col] for col in REQUIRED_COLUMNS)
+    return first.str.cat(rest, sep=' ').str.lower()
+
+# On-disk cache shared by every session and surviving server restarts.
+CACHE_DIR = pathlib.Path("~/.cache/foster").expanduser()
+# Entries older than this are rebuilt on use and deleted by the next write, so the
+# directory does not grow by one index per CSV version forever.
+CACHE_RETENTION = 30 * 86400
+
+def disk_cached(name, key, build, max_age=CACHE_RETENTION):
+    """
+    Returns build(), memoized on disk as CACHE_DIR/<name>-<key>.pkl.
+    Files older than max_age seconds are ignored and the value is rebuilt; files
+    that cannot be unpickled (truncated, or written by other numpy/pandas versions)
+    are deleted and rebuilt. Write errors are ignored.
+    """
+    path = CACHE_DIR / f"{name}-{key}.pkl"
+    try:
+        fresh = time.time() - path.stat().st_mtime < max_age
+    except OSError:
+        fresh = False
+    if fresh:
+        try:
+            with path.open('rb') as f:
+                return pickle.load(f)
+        except Exception:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    value = build()
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open('wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(path)
+        prune_cache()
+    except OSError:
+        pass
+    return value
+
+def prune_cache():
+    """
+    Deletes cache files (including stray .tmp files) older than CACHE_RETENTION.
+    """
+    cutoff = time.time() - CACHE_RETENTION
+    for path in CACHE_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+@st.cache_resource(show_spinner=False)
+def build_index(key, _file_bytes):
+    """
+    Inverted index of the corpus in CSR layout: (vocabulary, indptr, indices, tf, doc_len).
+    The rows containing token t are indices[indptr[vocabulary[t]]:indptr[vocabulary[t] + 1]],
+    with its count in each of those rows at the same positions of tf; doc_len holds the
+    token count of every row.
+    Persisted to disk by content hash; shared by reference across reruns and sessions,
+    so the arrays are made read-only.
+    """
+    index = disk_cached('index-v2', key, lambda: _index_arrays(key, _file_bytes))
+    for array in index[1:]:
+        array.flags.writeable = False
+    return index
+
+def _index_arrays(key, file_bytes):
+    vocabulary, token_ids, rows, counts, doc_len = {}, [], [], [], []
+    for row, text in enumerate(build_corpus(key, file_bytes)):
+        tokens = TOKEN_RE.findall(text)
+        doc_len.append(len(tokens))
+        for token, count in Counter(tokens).items():
+            token_ids.append(vocabulary.setdefault(token, len(vocabulary)))
+            rows.append(row)
+            counts.append(count)
+
+    token_ids = np.array(token_ids, dtype=np.int32)
+    order = np.argsort(token_ids, kind='stable')
+    indices = np.array(rows, dtype=np.int32)[order]
+    tf = np.array(counts, dtype=np.float32)[order]
+    indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(token_ids, minlength=len(vocabulary)), out=indptr[1:])
+    return vocabulary, indptr, indices, tf, np.array(doc_len, dtype=np.float32)
+
+def query_terms(text):
+    """
+    Distinct search terms of the user's scenario, sorted: word tokens of two or more
+    characters, minus stopwords.
+    """
+    return tuple(sorted({t for t in TOKEN_RE.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS}))
+
+# Okapi BM25 parameters: term-frequency saturation and document-length normalisation.
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+def score_rows(index, n_rows, user_terms):
+    """
+    Okapi BM25 relevance of each row to the user terms, computed from the posting
+    lists of the terms only. Rare terms weigh more than common ones, and long rows
+    do not win merely by containing more words. Rows sharing no term score 0.
+    """
+    vocabulary, indptr, indices, tf, doc_len = index
+    ids = [vocabulary[term] for term in user_terms if term in vocabulary]
+    if not ids:
+        return np.zeros(n_rows, dtype=np.float32)
+
+    spans = [slice(indptr[i], indptr[i + 1]) for i in ids]
+    doc_freq = np.array([s.stop - s.start for s in spans], dtype=np.float32)
+    idf = np.log1p((n_rows - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    rows = np.concatenate([indices[s] for s in spans])
+    freq = np.concatenate([tf[s] for s in spans])
+    weight = np.repeat(idf, doc_freq.astype(np.int64))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len[rows] / max(doc_len.mean(), 1))
+    contrib = weight * freq * (BM25_K1 + 1) / (freq + norm)
+    return np.bincount(rows, weights=contrib, minlength=n_rows).astype(np.float32)
+
+def top_k(scores, k):
+    """
+    Row positions of the k highest scores, best first, without sorting every row.
+    """
+    if len(scores) > k:
+        top = np.argpartition(scores, -k)[-k:]
+    else:
+        top = np.arange(len(scores))
+    # Best first, ties in file order.
+    top = np.sort(top)[::-1]
+    return top[np.argsort(scores[top], kind='stable')[::-1]]
+
+@st.cache_data(show_spinner=False)
+def build_context(key, _file_bytes, user_terms):
+    """
+    (context_type, context_data) for the prompt: the three best-matching reference
+    rows as a Markdown table, or a general-logic note when nothing matches.
+    Cached per (file, query terms), so re-wording with the same terms is free.
+    """
+    rows = build_table_rows(key, _file_bytes)
+    scores = score_rows(build_index(key, _file_bytes), len(rows), user_terms)
+    top_idx = top_k(scores, 3)
+    if scores[top_idx].max(initial=0) > 0:
+        return "Historic Matches", '\n'.join([*TABLE_HEADER, *(rows[i] for i in top_idx)])
+    return "General Logic", "(No historic matches; apply general credit-analyst logic.)"
+
+def markdown_row(values):
+    """
+    One Markdown table line (replaces tabulate's to_markdown); pipes are escaped and
+    newlines flattened so a cell cannot break the table.
+    """
+    def cell(value):
+        return '' if pd.isna(value) else str(value).replace('|', '\\|').replace('\n', ' ')
+
+    return '| ' + ' | '.join(cell(v) for v in values) + ' |'
+
+TABLE_HEADER = (markdown_row(REQUIRED_COLUMNS), '|' + '|'.join('---' for _ in REQUIRED_COLUMNS) + '|')
+
+@st.cache_resource(show_spinner=False)
+def build_table_rows(key, _file_bytes):
+    """
+    Markdown table line of every database row, rendered once per file, so a query
+    only joins the lines of its top matches.
+    """
+    frame = load_database(key, _file_bytes)[REQUIRED_COLUMNS]
+    return tuple(markdown_row(row) for row in frame.itertuples(index=False))
+
+# Proposal prompt, built once; only the deal details and reference rows change per click.
+# The static instructions are a strict prefix so the server can reuse it across calls.
+PROMPT_PREFIX = """\
+Role: Senior Credit Analyst at Foster Finance.
+Task: Write a deal summary ADAPTING the style of the Reference Database to the User's new scenario.
+
+INSTRUCTIONS:
+1. **Structure:** Output a numbered list (1, 2, 3) followed by a separate paragraph for the 4th point.
+2. **Tone:** Mimic the sentence structure of the Reference Database exactly.
+3. **Constraint:** Do NOT use bold headers (e.g., NO "**Requirement:**"). Just start the sentence.
+
+SPECIFIC MAPPING INSTRUCTIONS:
+* **Bullet 1 (Requirements):** Mimic the Reference Database sentence structure, BUT add 10-15% more detail by explicitly stating the likely credit priority (e.g., "prioritising competitive rates" or "maximum borrowing") if not already stated.
+* **Bullet 2 (Objectives):** Strictly mimic the 'Client Objectives' column style.
+* **Bullet 3 (Features):** Strictly mimic the 'Product Features' column style.
+* **Point 4 (Selection):** Strictly mimic the 'Why this Product was Selected' column logic.
+
+"""
+
+PROMPT_SUFFIX = """\
+REFERENCE DATABASE ({context_type}):
+{context_data}
+
+USER INPUT (New Deal Details):
+"{user_input}"
+
+Generate strict Markdown output.
+"""
+
+# Model auto-selection policy: each tier is a tuple of name fragments, tried in order.
+MODEL_PREFERENCES = (
+    ('gemini-3.0-flash', 'gemini-3-flash'),  # Priority 1: Gemini 3.0 Flash (The 2026 Standard)
+    ('gemini-1.5-flash',),                   # Priority 2: Gemini 1.5 Flash (The Stable Fallback)
+)
+
+def pick_model(available, preferences=MODEL_PREFERENCES):
+    """
+    Index of the default model: the first model matching the highest tier, else 0.
+    """
+    for fragments in preferences:
+        for i, m in enumerate(available):
+            if any(f in m for f in fragments):
+                return i
+    return 0
+
+@st.cache_resource
+def background_pool():
+    """
+    Worker threads shared by all sessions for work that should not block a rerun.
+    """
+    return ThreadPoolExecutor(max_workers=2)
+
+def start_index_build(key, file_bytes):
+    """
+    Future of build_index() for the uploaded file, started in the background as
+    soon as the file arrives, so the CSV parse and index build overlap the user
+    typing the deal scenario (and the model-list fetch). Kept in session_state,
+    so reruns reuse it until a different file is uploaded; a build that failed is
+    started again. Errors surface from .result() at scoring time, where they are
+    reported.
+    """
+    pending = st.session_state.get('index_future')
+    if pending is not None and pending[0] == key:
+        future = pending[1]
+        if not (future.done() and future.exception() is not None):
+            return future
+
+    ctx = get_script_run_ctx()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return build_index(key, file_bytes)
+
+    future = background_pool().submit(run)
+    st.session_state['index_future'] = (key, future)
+    return future